@@ -14,14 +14,18 @@ Kontakt: projekte@tim-walter.net
 
 import logging
 import asyncio
-import json
+import orjson
 
 # Konfiguration des Loggings
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 class AssistantTools:
     def __init__(self):
-        pass
+        # Allow-List der Funktionen, die die KI aufrufen darf. Neue Funktionen aus Teil 2
+        # müssen hier eingetragen und im Assistenten deklariert werden.
+        self._dispatch = {
+            "set_read_along": self.set_read_along,
+        }
 
     #TODO: Objekttypen von run einfügen
     async def execute_tool_calls(self, run) -> list:
@@ -34,54 +38,58 @@ class AssistantTools:
         :rtype: list
         """
 
-        queue = asyncio.Queue()
+        tool_calls = run.required_action.submit_tool_outputs.tool_calls
 
-        tasks = [self._handle_tool_call(tool_call, queue) for tool_call in run.required_action.submit_tool_outputs.tool_calls]
-        await asyncio.gather(*tasks)
-
-        tool_outputs = []
-        while not queue.empty():
-            tool_outputs.append(await queue.get())
+        # Meistens ist es nur ein einziger Tool Call; den rufen wir direkt auf, ohne den Umweg über gather()
+        if len(tool_calls) == 1:
+            results = [await self._handle_tool_call(tool_calls[0])]
+        else:
+            results = await asyncio.gather(*(self._handle_tool_call(tool_call) for tool_call in tool_calls))
 
-        return tool_outputs
+        # Jeder Tool Call muss beantwortet werden, sonst nimmt der Assistant die Tool Outputs nicht an
+        # und der Run bleibt in requires_action hängen, bis er abläuft. Fehlgeschlagene melden einen Fehlertext.
+        return list(results)
 
     #TODO: Objekttypen von tool_call einfügen
-    async def _handle_tool_call(self, tool_call, queue: asyncio.Queue) -> None:
+    async def _handle_tool_call(self, tool_call) -> dict:
         """
-        Führt einen einzelnen Tool Call aus und gibt das Ergebnis (threadsafe) in eine Queue.
+        Führt einen einzelnen Tool Call aus und gibt das Ergebnis zurück.
 
         :param tool_call: Der Tool Call, der ausgeführt werden soll.
         :type tool_call: dict
-        :param queue: Die Queue, in die das Ergebnis geschrieben wird.
-        :type queue: asyncio.Queue
+        :return: Das Ergebnis des Tool Calls; konnte er nicht ausgeführt werden, mit einer Fehlermeldung als Output.
+        :rtype: dict
         """
+        # Lazy %-formatting: the arguments are only rendered if the log level is actually enabled
         if tool_call.type == "function": # Other types not handled here yet
             function_name = tool_call.function.name
-            args = json.loads(tool_call.function.arguments)
-            logging.info(f"I shall call function {function_name} with arguments {args}")
-            method = getattr(self, function_name, None)
+            logging.info("I shall call function %s with arguments %s", function_name, tool_call.function.arguments)
+            method = self._dispatch.get(function_name)
             if method:
-                logging.info(f"Method found in AssistantTools Class - calling {function_name} with arguments {args}")
+                logging.info("Method found in AssistantTools dispatch table - calling %s", function_name)
                 try:
-                    logging.info(f"Calling {function_name} with arguments {args}")
+                    args = orjson.loads(tool_call.function.arguments)
+                    logging.info("Calling %s with arguments %r", function_name, args)
                     output_value = await method(**args)
                     result = {"tool_call_id": tool_call.id, "output": output_value}
                 except Exception as e:
-                    logging.error(f"Error calling {function_name} with arguments {args}: {e}")
+                    logging.error("Error calling %s with arguments %s: %s", function_name, tool_call.function.arguments, e)
+                    result = {"tool_call_id": tool_call.id, "output": f"Error: Function {function_name} failed."}
             else:
-                logging.error(f"Function {function_name} not found.")
+                logging.error("Function %s not found or not allowed.", function_name)
+                result = {"tool_call_id": tool_call.id, "output": f"Error: Function {function_name} is not available."}
 
-            await queue.put(result)
-            logging.debug(f"Result of {function_name}, which is {result}, was added to the results queue.")
+            logging.debug("Result of %s is %r.", function_name, result)
+            return result
         else:
             logging.error(f"Tool Call type {tool_call.type} is not supported yet.")
-            raise NotImplementedError(f"Tool Call type {tool_call.type} is not supported yet.")
+            return {"tool_call_id": tool_call.id, "output": f"Error: Tool Call type {tool_call.type} is not supported."}
 
     """
     Teil 2 der AssistantTools-Klasse
     
     Die folgenden Methoden sind die von der KI aufgerufenen Funktionen.
-    Damit sie aufgerufen werden, müssen sie im Assistenten deklariert werden.
+    Damit sie aufgerufen werden, müssen sie im Assistenten deklariert und in self._dispatch eingetragen werden.
     Dies geschieht momentan noch manuell.
     """
 
@@ -98,24 +106,15 @@ class AssistantTools:
         :rtype: str
         """
 
-        from user_threads import UserThreads
-
         try:
             toggle = int(read_along)
         except ValueError:
             logging.error(f"Invalid value for read along: {read_along}")
             return "Invalid value for read along. Please use 0 or 1."
         
-        #Todo: Man sollte sich überlegen, ob die Verbindung zum Storage Account bzw. zur dortigen Benutzer-
-        #tabelle nicht während des gesamten Dialogschrittes offen gehalten wird, und die Verbindung
-        #hier in Methoden injiziert wird, um unnötigen Verbindungsauf- und abbau zu vermeiden.
-
-        #Todo: offenbar kennt UserThreads auch kein __enter__ und __exit__ für einen Kontext.
-        #Wenn schon Verbindung aufbauen, dann bitte mit With-Clause. Ändern.
-
-        #Todo: Die UserThreads() Klasse muss, so oder so, asynchron werden...
-        # user_threads = await UserThreads.create_async()
-        user_threads = UserThreads() #... ist sie aber noch nicht :-()
+        # Die prozessweit geteilte UserThreads-Instanz, damit nicht für jeden Tool Call eine neue angelegt wird
+        from user_threads import get_users
+        user_threads = get_users()
 
         current_read_along_setting = await user_threads.get_extended_events(email)
 
@@ -127,8 +126,6 @@ class AssistantTools:
             logging.info(f"Read along for {email} now set to {read_along}")
             ret_str = f"Mitlesen für {email} wurde erfolgreich {'deaktiviert' if toggle==0 else 'aktiviert'}"
 
-        await user_threads.close()
-        
         logging.info(f"Setting read along for {email} to {read_along}")
 
         return ret_str
\ No newline at end of file
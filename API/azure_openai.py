@@ -4,9 +4,8 @@ Titel: azure_openai.py
 Beschreibung: Stellt die Kommunikation zwischen der Funktion App und der Azure OpenAI API her.
               Diese Datei nutzt spezifische Azure OpenAI Endpunkte und Konfigurationen für die Interaktion.
               "Schwesterdatei" ist o_openai.py, die auf allgemeine OpenAI-Endpunkte zugreift.
-              Modul ist nun vollständig auf async umgestellt. Eine Async-Library für die Assistant-API
-              war noch nicht verfügbar, wird aber mit Release der API seitens OpenAI sicher verfügbar sein.
-              Auf die Verwendung der Hilfsmethode async_api_call() kann dann später verzichtet werden.
+              Modul ist nun vollständig auf async umgestellt. Es nutzt den asynchronen Client AsyncAzureOpenAI,
+              die frühere Hilfsmethode async_api_call() mit ihrem Umweg über einen Thread-Pool entfällt damit.
 
 Autor: Tim Walter (TechPrototyper)
 Datum: 2024-04-11
@@ -15,14 +14,15 @@ Quellen: [OpenAI API Dokumentation], [Azure Functions Dokumentation], [Azure Tab
 Kontakt: projekte@tim-walter.net
 """
 
-from openai import AzureOpenAI  # Angenommen, dies ist der korrekte Importpfad
-from user_threads import UserThreads
+from openai import AsyncAzureOpenAI, DefaultAsyncHttpxClient
+import httpx
+from user_threads import get_users
 # from typing import Tuple
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import functools
 import os
 import logging
-from event_grid_publisher import EventGridPublisher
+from event_grid_publisher import get_publisher
 from assistant_tools import AssistantTools
 import re
 from datetime import datetime
@@ -31,6 +31,52 @@ from datetime import datetime
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Error message of the Assistant API when a message is added to a thread with an active run, e.g.
+# "Can't add messages to thread_abc while a run run_xyz is active."
+_RUN_ACTIVE_RE = re.compile(r"Can't add messages to thread_(?P<thread>[a-zA-Z0-9]+) while a run run_(?P<run>[a-zA-Z0-9]+) is active\.")
+
+# Runs are read as streams (runs.stream, submit_tool_outputs_stream); Azure OpenAI supports that for the
+# Assistant API from this API version on. Versions are dates, so they compare as strings.
+_MIN_STREAMING_API_VERSION = "2024-05-01-preview"
+
+
+@functools.lru_cache(maxsize=1)
+def _get_client() -> AsyncAzureOpenAI:
+    """
+    Liefert den prozessweit geteilten Azure OpenAI Client. Er wird beim ersten Aufruf angelegt und
+    bleibt für die Lebensdauer des Workers offen, damit TLS-Verbindungen über Anfragen hinweg wiederverwendet werden.
+
+    :raises EnvironmentError: Wenn die Umgebungsvariablen nicht gesetzt sind.
+    :raises Exception: Wenn keine Verbindung zur Azure OpenAI API hergestellt werden kann.
+    """
+    api_key = os.getenv("AZURE_OPENAI_API_KEY")
+    endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
+    api_version = os.getenv("AZURE_OPENAI_API_VERSION")
+
+    if not api_key or not endpoint:
+        logging.error("AZURE_OPENAI_API_KEY oder AZURE_OPENAI_ENDPOINT ist nicht gesetzt.")
+        raise EnvironmentError("AZURE_OPENAI_API_KEY oder AZURE_OPENAI_ENDPOINT Umgebungsvariable ist nicht gesetzt.")
+
+    if api_version and api_version[:10] < _MIN_STREAMING_API_VERSION[:10]:
+        # Every chat would fail; the error message of the API itself does not point to the version
+        logging.error("AZURE_OPENAI_API_VERSION %s unterstützt kein Streaming der Assistant API, mindestens %s ist nötig.",
+                      api_version, _MIN_STREAMING_API_VERSION)
+
+    try:
+        # Keep-alive pool with HTTP/2, so the many calls to the endpoint share a single TLS connection.
+        # DefaultAsyncHttpxClient keeps the SDK's client defaults (e.g. follow_redirects). The read timeout
+        # stays at the SDK's 600s: runs are read as streams, and a queued or throttled run or a long tool step
+        # may well send no event for more than 30s.
+        http_client = DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            timeout=httpx.Timeout(600.0, connect=5.0)
+        )
+        return AsyncAzureOpenAI(api_key=api_key, api_version=api_version, azure_endpoint=endpoint, http_client=http_client)
+    except Exception as e:
+        logging.error(f"Konnte keine Verbindung zur Azure OpenAI API herstellen: {e}")
+        raise
+
 
 class InteractWithOpenAI:
     """
@@ -39,12 +85,9 @@ class InteractWithOpenAI:
 
     """
 
-    async def async_api_call(self, method, *args, **kwargs):
-        loop = asyncio.get_running_loop()
-        with ThreadPoolExecutor() as pool:
-            result = await loop.run_in_executor(pool, method, *args, **kwargs)
-            return result
-
+    # Event publications still in flight, shared by all instances. They outlive the request that started them,
+    # so the response to the user never waits for the EventGrid; the set only keeps them from being garbage collected.
+    _pending_tasks = set()
 
     def __init__(self):
         """
@@ -53,35 +96,22 @@ class InteractWithOpenAI:
         :raises EnvironmentError: Wenn die Umgebungsvariablen nicht gesetzt sind.
         :raises Exception: Wenn keine Verbindung zur Azure OpenAI API hergestellt werden kann.
         """
-        api_key = os.getenv("AZURE_OPENAI_API_KEY")
-        endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
         self.main_assistant_id = os.getenv("AZURE_OPENAI_MAIN_ASSISTANT_ID")
-        api_version = os.getenv("AZURE_OPENAI_API_VERSION")
-        
-        if not api_key or not endpoint:
-            logging.error("AZURE_OPENAI_API_KEY oder AZURE_OPENAI_ENDPOINT ist nicht gesetzt.")
-            raise EnvironmentError("AZURE_OPENAI_API_KEY oder AZURE_OPENAI_ENDPOINT Umgebungsvariable ist nicht gesetzt.")
-        
-        try:            
-            self.client = AzureOpenAI(api_key=api_key, api_version=api_version, azure_endpoint=endpoint)
-        except Exception as e:
-            logging.error(f"Konnte keine Verbindung zur Azure OpenAI API herstellen: {e}")
-            raise
+        self.client = _get_client()
 
+        # The UserThreads instance of the worker process is only fetched in get_or_create_thread(), inside chat()'s try,
+        # so a missing storage configuration comes back as an *ISSUE* answer; the local functions fetch the same one
+        self.threads = None
         self.assistant_tools = AssistantTools()
+        self._events = []
 
     async def close(self):
         """
-        Schließt die Verbindung zur Azure OpenAI API und zu Azure Table Storage.
+        Gibt die Ressourcen des Dialogschrittes frei. Der Azure OpenAI Client und die UserThreads-Instanz
+        werden prozessweit geteilt und bleiben deshalb offen; derzeit gibt es hier nichts zu tun.
 
         :return: None
         """
-        if hasattr(self, 'client') and hasattr(self.client, 'close'):
-            await self.async_api_call(lambda: self.client.close())
-            logging.info("Azure OpenAI API Verbindung geschlossen.")
-        if hasattr(self, 'threads') and hasattr(self.threads, 'close'):
-            await self.threads.close()
-            logging.info("Azure Table Storage Verbindung geschlossen.")
 
     async def __aenter__(self):
         """
@@ -93,13 +123,48 @@ class InteractWithOpenAI:
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         """
-        Schließt die Verbindung zur Azure OpenAI API und zu Azure Table Storage beim Verlassen des Kontexts.
+        Ruft beim Verlassen des Kontexts close() auf. Die prozessweit geteilten Verbindungen
+        zu Azure OpenAI und Azure Table Storage bleiben dabei offen.
 
         :return: False
         """
         await self.close()
         return False
 
+    def _add_event(self, event_type: str, details: dict):
+        """
+        Merkt ein Event für das Azure EventGrid vor. Alle Events eines Dialogschrittes
+        werden am Ende von chat() gesammelt in einem einzigen Request verschickt.
+
+        :param event_type: Der Typ des Events, z.B. "user.registered".
+        :param details: Die Nutzdaten des Events.
+        """
+        self._events.append((event_type, details))
+
+    async def _send_events(self, events: list):
+        """
+        Sendet die gesammelten Events über den prozessweit geteilten Publisher. Fehler werden nur protokolliert,
+        da die Events für die Antwort an den Benutzer nicht gebraucht werden.
+
+        :param events: Liste von Tupeln aus Event-Typ und Nutzdaten.
+        """
+        try:
+            await get_publisher().send_events(events)
+        except Exception as e:
+            logging.error(f"Events konnten nicht veröffentlicht werden: {e}")
+
+    def _flush_events(self):
+        """
+        Startet das Versenden der vorgemerkten Events als Hintergrund-Task, damit die Antwort nicht darauf wartet.
+        Weder chat() noch close() warten auf den Task, er läuft nach dem Ende des Requests weiter.
+        """
+        if not self._events:
+            return
+        task = asyncio.create_task(self._send_events(self._events))
+        self._events = []
+        self._pending_tasks.add(task)
+        task.add_done_callback(self._pending_tasks.discard)
+
     async def get_or_create_thread(self, user_email: str) -> str:
         """
         Ermittelt oder erstellt einen Thread für den gegebenen Benutzer in Azure.
@@ -109,34 +174,23 @@ class InteractWithOpenAI:
         :return: Die ID des Threads.
         """
 
-        try:
-            self.threads = UserThreads()
-            thread_id = await self.threads.get_id(user_email)
+        async def create_thread() -> str:
+            thread = await self.client.beta.threads.create()
+            return thread.id
 
-            user_details = {"email": user_email, "thread_id": thread_id}
-
-            # That's not precisely right, because we'not only coming here on login,
-            # but in fact on every prompt. Hence, we should not send this event here:
-            # async with EventGridPublisher() as publisher:
-            #     await publisher.send_event("user.login", user_details)
-
-        except LookupError: # No known conversation for this user as of now
-            try:
-                thread = await self.async_api_call(self.client.beta.threads.create)
-                thread_id = thread.id 
-                await self.threads.set_id(user_email, thread_id)
-                # After we're done, we'll let the world know that a user has registered...
-                user_details = {"email": user_email, "thread_id": thread_id}                
-                async with EventGridPublisher() as publisher:
-                    await publisher.send_event("user.registered", user_details)
-
-            except Exception as e:
-                logging.error(f"Fehler bei der Thread-Erstellung oder -Speicherung: {e}")
-                raise
+        try:
+            self.threads = get_users()
+            # Read, and only for unknown users create the thread; parallel first prompts end up on one thread
+            thread_id, created = await self.threads.get_or_set_id(user_email, create_thread)
         except Exception as e:
-            logging.error(f"Ein unbekannter Fehler beim Zugriff auf die Thread-Historie ist aufgetreten: {e}")
+            logging.error(f"Fehler bei der Thread-Ermittlung, -Erstellung oder -Speicherung: {e}")
             raise
 
+        if created:
+            # After we're done, we'll let the world know that a user has registered...
+            user_details = {"email": user_email, "thread_id": thread_id}
+            self._add_event("user.registered", user_details)
+
         # ... and return the Thread-Id for further processing
         return thread_id
 
@@ -162,8 +216,7 @@ class InteractWithOpenAI:
             # If so, we will send the prompt typed in to the EventGrid to whom it may concern
             if transscript_allowed == 1:
                 details = {"email": user_email, "Name: ": user_name,"prompt": user_prompt}
-                async with EventGridPublisher() as publisher:
-                    await publisher.send_event("prompt.from.user", details)            
+                self._add_event("prompt.from.user", details)
 
             # Let's embed the user's input into some information block for the LLM:
             modified_prompt = await self.create_modified_prompt(user_name, user_email, user_prompt, transscript_allowed)        
@@ -173,8 +226,8 @@ class InteractWithOpenAI:
 
             if transscript_allowed == 1: # If we're allowed...
                 details = {"email": user_email, "Name: ": user_name,"prompt": modified_prompt}
-                async with EventGridPublisher() as publisher: # we let the world know that we've sent the prompt to the AI
-                    await publisher.send_event("prompt.to.ai", details)   
+                # we let the world know that we've sent the prompt to the AI
+                self._add_event("prompt.to.ai", details)
 
             # We've added a message to the thread, and now we'll order the LLM to work on the dialog by starting a run
             # We may have to do things in between such as executing local functions etc.
@@ -186,28 +239,51 @@ class InteractWithOpenAI:
         except Exception as e: # Outer try, just for safety reasons
             logging.error(f"Chat-Error: {e}")
             return 509, f"*ISSUE* **{e}**"
+
+        finally: # Whatever happened, all events of this turn go out to the EventGrid in one go
+            self._flush_events()
     
+    @staticmethod
+    async def _consume_run_stream(stream_manager):
+        """
+        Liest einen Run-Stream bis zum Ende und liefert den letzten Run-Zustand sowie die zuletzt fertiggestellte Nachricht.
+
+        :param stream_manager: Der noch nicht geöffnete Stream, z.B. aus runs.stream() oder runs.submit_tool_outputs_stream().
+        :return: Tupel aus Run-Objekt (oder None) und Message-Objekt (oder None).
+        """
+        message = None
+        async with stream_manager as stream:
+            async for event in stream:
+                if event.event == "thread.message.completed":
+                    message = event.data
+            return stream.current_run, message
+
     async def update_run(self, tool_outputs, thread_id, run_id):
-        # Sendet die verarbeiteten Tool-Ausgaben zurück an die OpenAI-API
-        run = await self.async_api_call(
-            lambda: self.client.beta.threads.runs.submit_tool_outputs(
+        # Sendet die verarbeiteten Tool-Ausgaben zurück an die OpenAI-API und verfolgt den Run per Stream weiter
+        return await self._consume_run_stream(
+            self.client.beta.threads.runs.submit_tool_outputs_stream(
                 thread_id=thread_id,
                 run_id=run_id,
                 tool_outputs=tool_outputs
             )
         )
-        return run
     
     async def check_transscript_permission(self, user_email: str) -> bool:
-        u = UserThreads()
-        transscript_allowed = await u.get_extended_events(user_email)
-        logging.info(f"Transscript allowance checked for {user_email}: Value is {str(transscript_allowed)}")
+        transscript_allowed = await self.threads.get_extended_events(user_email)
+        logging.info("Transscript allowance checked for %s: Value is %s", user_email, transscript_allowed)
         return transscript_allowed
     
     async def create_modified_prompt(self, user_name: str, user_email: str, user_prompt: str, transscript_allowed: int) -> str:
-        time_stamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        modified_prompt = f"Mein Name: {user_name}\nMeine E-Mail Adresse: {user_email}\nDatum und Uhrzeit: {time_stamp}\nStatus der Mitleseerlaubnis: {str(transscript_allowed)}\nMein Prompt: {user_prompt}"
-        logging.info(f"Modified prompt created: {modified_prompt}")
+        time_stamp = datetime.now().isoformat(sep=" ", timespec="seconds") # Same format as strftime("%Y-%m-%d %H:%M:%S"), without the locale path
+        # Built once per turn, before prepare_message() and its retry loop, from plain fragments
+        modified_prompt = "\n".join((
+            "Mein Name: " + user_name,
+            "Meine E-Mail Adresse: " + user_email,
+            "Datum und Uhrzeit: " + time_stamp,
+            "Status der Mitleseerlaubnis: " + ("1" if transscript_allowed == 1 else "0"),
+            "Mein Prompt: " + user_prompt,
+        ))
+        logging.debug("Modified prompt created: %s", modified_prompt) # Full prompt only at DEBUG: personal data, and it may be long
         return modified_prompt
     
     async def prepare_message(self, thread_id: str, user_name: str, user_email: str, modified_prompt: str):
@@ -215,131 +291,125 @@ class InteractWithOpenAI:
         while True: # We have to loop because we may find the thread being in a run;
                     # in this case we have to cancel it first and then go again
             try:
-                await self.async_api_call(lambda: self.client.beta.threads.messages.create(
+                await self.client.beta.threads.messages.create(
                     thread_id=thread_id,
                     role="user",
                     content=modified_prompt
-                ))
-                logging.info(f"Prepare Message: Object created successfully.")
+                )
+                logging.debug("Prepare Message: Object created successfully.")
                 break
             except Exception as e: # Message could not be created/sent, let's check the run status
-                logging.info(f"Prepare Message Error: {e}")
+                logging.info("Prepare Message Error: %s", e)
                 
                 # If the message is rejected because the thread has an active run,
                 # the error message from OpenAI will contain the thread_id and run_id - we can extract them:
-                error_str = str(e) # From a string
-                if "Can't add messages to" in error_str and "while a run" in error_str and "is active." in error_str:
-                    # I love regex... 
-                    thread_id_match = re.search(r"thread_([a-zA-Z0-9]+)", error_str)
-                    run_id_match = re.search(r"run_([a-zA-Z0-9]+)", error_str)
-                    
-                    if thread_id_match and run_id_match: # And indeed, we found'em:
-                        thread_id = "thread_"+thread_id_match.group(1)
-                        run_id = "run_"+run_id_match.group(1)
-                        logging.info(f"Prepare message: Error reports Thread ID: {thread_id}, Run ID: {run_id}")
+                # One compiled pattern checks for the error and extracts both id's in a single scan
+                run_active_match = _RUN_ACTIVE_RE.search(str(e))
+                if run_active_match: # I love regex...
+                    thread_id = "thread_" + run_active_match.group("thread")
+                    run_id = "run_" + run_active_match.group("run")
+                    logging.info("Prepare message: Error reports Thread ID: %s, Run ID: %s", thread_id, run_id)
 
-                        # Let's cancel the run and try again
+                    # Let's cancel the run and try again
 
-                        await self.async_api_call(
-                            lambda: self.client.beta.threads.runs.cancel(run_id=run_id, thread_id=thread_id)
-                        )
+                    await self.client.beta.threads.runs.cancel(run_id=run_id, thread_id=thread_id)
 
-                        logging.info(f"Prepare Message: Run {run_id} cancelled.")
+                    logging.info("Prepare Message: Run %s cancelled.", run_id)
 
-                    else:
-                        logging.info("Prepare message: Unknown error, no Id's could be extracted.")
                 else:
                     logging.error(f"Prepare Message: Unknown error: {e}")
                     #TODO: Fehlerbehandlung anpassen
                     # return 500, f"*ISSUE* **{e}**"
 
+    # Handlers for the run statuses that end a dialog step. They all share one signature and return (http_status, response_body).
+
+    async def _on_run_completed(self, message, user_name: str, user_email: str, transscript_allowed: int):
+        # We got a reply for the user from the LLM - this is what we want.
+        # The stream has already handed us the final message, so let's see what's in it ...
+        # Well, a message should contain something, right?
+        if message and message.content:
+            # Yeah, we got something, let's get it out of the JSON structure
+            return_prompt = message.content
+            # And extract the text value from the JSON            
+            response_body = return_prompt[0].text.value     
+            logging.debug("Response: %s", response_body) # Same as the prompt: the reply text is logged at DEBUG only
+
+            # If we're allowed to read the conversation, we'll send the response from the LLM to the EventGrid
+            if transscript_allowed == 1:
+                details = {"email": user_email, "Name: ": user_name,"prompt": response_body}
+                self._add_event("prompt.from.ai", details)
+
+                # Don't be surprised we're doing the same thing twice;
+                # This is due to envisioned future changes
+                # We may have to unwind magic strings here, or check for some trigger
+                # words, or whatever.
+                # In the future, the response from the AI may well be different to what we're
+                # sending to the user. Of course that is not the case right now, so it may look
+                # a bit redundant. But it's not :-)
+
+                details = {"email": user_email, "Name: ": user_name,"ai_prompt": response_body}
+                self._add_event("prompt.to.user", details)
+            
+            # Off we go:
+            return 200, response_body
+        else:
+            # Well, we got a message, but it's empty. That's bizarre. Wonder if that ever happens.
+            return 200, "Da fällt mir im Moment gerade nichts zu ein (Leere Nachricht von der KI)."
+
+    async def _on_run_cancelled(self, message, user_name: str, user_email: str, transscript_allowed: int):
+        # Should never happen, we have no feature to support cancelling an interaction such as in ChatGPT
+        # Once the stream is over, there's nothing left to wait for, even if the run is still "cancelling".
+        # Watch the magic string here that tells the Frontend to finish the chat
+        return 200, "Chat abgebrochen. /(ENDE)\\"
+
+    async def _on_run_expired(self, message, user_name: str, user_email: str, transscript_allowed: int):
+        return 200, "Ich bin scheinbar im Moment nicht in der Lage, eine Antwort zu formulieren. Ich bitte um Entschuldigung. Evtl. versuchen Sie es später nochmals. /(ENDE)\\"
+
+    async def _on_run_failed(self, message, user_name: str, user_email: str, transscript_allowed: int):
+        return 200, "Oh, auch künstliche Intelligenz ist nicht unfehlbar, so wie Gott. Ihre Anfrage konnte nicht verarbeitet werden. Bitte versuchen Sie es erneut."
+
+    _RUN_STATUS_HANDLERS = {
+        "completed": _on_run_completed,
+        "cancelled": _on_run_cancelled,
+        "cancelling": _on_run_cancelled,
+        "expired": _on_run_expired,
+        "failed": _on_run_failed,
+    }
+
     async def create_and_monitor_run(self, thread_id: str, user_name: str, user_email: str, transscript_allowed: int) -> str:
 
-            # We've added a message to the thread, and now we'll order the LLM to work on the dialog by starting a run
-            run = await self.async_api_call(
-                lambda: self.client.beta.threads.runs.create(
-                    thread_id=thread_id,
-                    assistant_id=self.main_assistant_id
-                )
+            # We've added a message to the thread, and now we'll order the LLM to work on the dialog by starting a run.
+            # The run is streamed: Azure OpenAI pushes every status change to us, so there's no polling any more,
+            # and the stream only ends once the run is finished or waits for us to act.
+            updated_run, message = await self._consume_run_stream(
+                self.client.beta.threads.runs.stream(thread_id=thread_id, assistant_id=self.main_assistant_id)
             )
 
-            logging.info(f"Run created, Run ID: {run.id}")
+            while True:
+                if updated_run is None: # The stream ended without telling us anything about the run
+                    logging.error("Problem beim Durchführen des Runs: Kein Run-Status im Stream.")
+                    return 500, "*ISSUE* **Run Status: unknown**"
 
+                status = updated_run.status # Read once, the SDK object's attribute access isn't free
+                logging.info("Run %s, Status: %s", updated_run.id, status)
 
-            while True:
-                # Wait for run to return with a status
-                while True:
-                    # Wait until Azure OpenAI comes back with any actionable state
-                    # updated_run = self.client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-                    updated_run = await self.async_api_call(
-                        lambda: self.client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-                    )
-                    logging.info(f"Run Status: {updated_run.status}")
-                    if updated_run.status not in ["queued", "in_progress"]:
-                        logging.info(f"... Run Status: {updated_run.status}")
-                        break
-                    await asyncio.sleep(1)
+                # Let's see where we got with the run so far...
+                handler = self._RUN_STATUS_HANDLERS.get(status)
+                if handler: # The run is over, one way or the other
+                    return await handler(self, message, user_name, user_email, transscript_allowed)
 
-                
-                match updated_run.status: # Let's see where we got with the run so far...
-                    case "completed": # We got a reply for the user from the LLM - this is what we want.
-                        # So let's get it out of the thread ...
-                        messages = await self.async_api_call(
-                            lambda: self.client.beta.threads.messages.list(thread_id=thread_id)
-                        )
-                        # Well, a message should be longer then zero and contain something, right?
-                        if messages.data and len(messages.data) > 0 and messages.data[0].content:
-                            # Yeah, we got something, let's get it out of the JSON structure
-                            return_prompt = messages.data[0].content
-                            # And extract the text value from the JSON            
-                            response_body = return_prompt[0].text.value     
-                            logging.info(f"Response: {response_body}")
-
-                            # If we're allowed to read the conversation, we'll send the response from the LLM to the EventGrid
-                            if transscript_allowed == 1:
-                                details = {"email": user_email, "Name: ": user_name,"prompt": response_body}                                
-                                async with EventGridPublisher() as publisher:
-                                    await publisher.send_event("prompt.from.ai", details)            
-
-                                # Don't be surprised we're doing the same thing twice;
-                                # This is due to envisioned future changes
-                                # We may have to unwind magic strings here, or check for some trigger
-                                # words, or whatever.
-                                # In the future, the response from the AI may well be different to what we're
-                                # sending to the user. Of course that is not the case right now, so it may look
-                                # a bit redundant. But it's not :-)
-
-                                details = {"email": user_email, "Name: ": user_name,"ai_prompt": response_body}
-                                async with EventGridPublisher() as publisher:
-                                    await publisher.send_event("prompt.to.user", details)            
-                            
-                            # Off we go:
-                            return 200, response_body
-                        else:
-                            # Well, we got a message, but it's empty. That's bizarre. Wonder if that ever happens.
-                            return 200, "Da fällt mir im Moment gerade nichts zu ein (Leere Nachricht von der KI)."
-                    case "cancelled": # Should never happen, we have no feature to support cancelling an interaction such as in ChatGPT
-                        # Watch the magic string here that tells the Frontend to finish the chat
-                        return 200, "Chat abgebrochen. /(ENDE)\\"
-                    case "cancelling": # Same here, although, if for any reason this is happening, we will actually wait until the state changes to "cancelled"
-                        pass
-                    case "pending": # Not sure whether this is a real valid state. It appears in documentation, but code editor does not recognize it for autocompletion
-                        pass # Something is going to happen, but we don't know yet
-                    case "expired":
-                        return 200, "Ich bin scheinbar im Moment nicht in der Lage, eine Antwort zu formulieren. Ich bitte um Entschuldigung. Evtl. versuchen Sie es später nochmals. /(ENDE)\\"
-                    case "failed":
-                        return 200, "Oh, auch künstliche Intelligenz ist nicht unfehlbar, so wie Gott. Ihre Anfrage konnte nicht verarbeitet werden. Bitte versuchen Sie es erneut."
+                match status:
                     case "requires_action": # The AI wants to act autonomously, let's let it do so_
                         logging.info("In Run: Action required.")
                         # This nice function here will execute all known local functions simultaneously
                         # wait for all functions to finish, and settle the results; once we got'em, we'll
                         # be reporting them back to the LLM:
                         results = await self.assistant_tools.execute_tool_calls(updated_run)
-                        logging.debug(f"In Run: Results from local function calls: {results}")
-                        if results:
-                            updated_run = await self.update_run(results, thread_id, updated_run.id)
+                        # Every tool call gets an output, failed ones an error text, so the run can always continue
+                        logging.debug("In Run: Results from local function calls: %r", results)
+                        updated_run, message = await self.update_run(results, thread_id, updated_run.id)
 
                     case _: # Unknown state, let's break out here
-                        logging.error(f"Problem beim Durchführen des Runs: {updated_run.status}")
-                        return 500, f"*ISSUE* **Run Status: {updated_run.status}**"
+                        logging.error(f"Problem beim Durchführen des Runs: {status}")
+                        return 500, f"*ISSUE* **Run Status: {status}**"
                     
@@ -11,55 +11,61 @@ Kontakt:        projekte@tim-walter.net
 """
 
 """
-Refactored. Now uses Event-Factory in my_cloudevents.py
-and identifies the correct factory method by using Python's reflection.
-This keeps boiler plate code at a minimum and is very effective.
+Refactored. Now uses Event-Factory in my_cloudevents.py.
+The event types are looked up in the table there, so new types need no code here.
 """
 
 from azure.eventgrid.aio import EventGridPublisherClient
 from azure.core.credentials import AzureKeyCredential
 import os
-import asyncio
+import functools
 import logging
-from my_cloudevents import BaseCloudEvent
+from my_cloudevents import create_event
+from pooled_transport import create_transport
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Process-wide publisher, see get_publisher()
+_publisher = None
+
+# Idle connections to the grid are kept open this long (seconds). aiohttp's default of 15s
+# is shorter than the usual gap between two chat turns, which costs a new TLS handshake.
+_KEEPALIVE_TIMEOUT = 120
+
+@functools.lru_cache(maxsize=None)
+def _get_client(endpoint: str, access_key: str) -> EventGridPublisherClient:
+    # One client per grid endpoint and key; it stays open for the lifetime of the worker process,
+    # so its HTTP session and TLS connection are reused by every publisher.
+    # Must be called from within the running event loop, the aiohttp session is bound to it.
+    credential = AzureKeyCredential(access_key)
+    transport = create_transport(keepalive_timeout=_KEEPALIVE_TIMEOUT)
+    return EventGridPublisherClient(endpoint, credential, transport=transport)
+
 class EventGridPublisher:
     def __init__(self):
-        try:
-            self.endpoint = os.getenv("EVENT_GRID_ENDPOINT")
-            self.credential = AzureKeyCredential(os.getenv("EVENT_GRID_ACCESS_KEY"))
-        except KeyError as e:
-            logging.error(f"Error: {e}")
-            raise
+        # Runs once per worker process (see get_publisher()), so the settings are read only once
+        self.endpoint = os.getenv("EVENT_GRID_ENDPOINT")
+        access_key = os.getenv("EVENT_GRID_ACCESS_KEY")
+        if not self.endpoint or not access_key:
+            logging.error("EVENT_GRID_ENDPOINT oder EVENT_GRID_ACCESS_KEY Umgebungsvariable ist nicht gesetzt.")
+            raise EnvironmentError("EVENT_GRID_ENDPOINT oder EVENT_GRID_ACCESS_KEY Umgebungsvariable ist nicht gesetzt. Function App muss konfiguriert werden.")
+        self.client = _get_client(self.endpoint, access_key)
 
     async def __aenter__(self):
-        self.client = EventGridPublisherClient(self.endpoint, self.credential)
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         if exc_type:
             logging.error(f"Error: {exc_type}: {exc_val}")
+        # The shared client is not closed here, see _get_client()
 
-        await self.client.close()
 
+    def _create_event(self, event_type: str, details: dict):
+        # Raises a ValueError for an unknown event_type
+        return create_event(event_type, details)
 
     async def send_event(self, event_type: str, details: dict):
-        # Use reflection to get the correct factory method
-        # First, convert "." to "_" in the event type to match the method name
-        method_name = f"create_{event_type.replace('.', '_')}_event"
-
-        # Now look the Method up in the BaseCloudEvent class
-        event_factory_method = getattr(BaseCloudEvent, method_name, None)
-
-        # No factroy for the event_type passed...
-        if not event_factory_method:
-            # ... leads to a ValueError:
-            raise ValueError(f"EventGridPublisher: Event factory method for {event_type} not found.")
-        
-        # Otherwise, create the event...
-        event = event_factory_method(details)
+        event = self._create_event(event_type, details)
 
         try:
             # ... and send it
@@ -67,4 +73,27 @@ class EventGridPublisher:
             logging.info(f"EventGridPublisher: {event_type} Event sent to grid.")
 
         except Exception as e:
-            logging.error(f"EventGridPublisher: {event_type} Event failed to publish: {e}")
\ No newline at end of file
+            logging.error(f"EventGridPublisher: {event_type} Event failed to publish: {e}")
+
+    async def send_events(self, events: list):
+        # Sends several events in one single request to the grid.
+        # events is a list of (event_type, details) tuples, in the order they occurred.
+        cloud_events = [self._create_event(event_type, details) for event_type, details in events]
+        event_types = ", ".join(event_type for event_type, _ in events)
+
+        try:
+            await self.client.send(cloud_events)
+            logging.info(f"EventGridPublisher: {event_types} Events sent to grid.")
+
+        except Exception as e:
+            logging.error(f"EventGridPublisher: {event_types} Events failed to publish: {e}")
+
+
+def get_publisher() -> EventGridPublisher:
+    """
+    Returns the publisher shared by all requests of this worker process.
+    """
+    global _publisher
+    if _publisher is None:
+        _publisher = EventGridPublisher()
+    return _publisher
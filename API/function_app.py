@@ -12,18 +12,29 @@ Kontakt: projekte@tim-walter.net
 """
 
 import azure.functions as func
-from azure.monitor.opentelemetry import configure_azure_monitor
-from opentelemetry import trace
 import logging
-from datetime import datetime
-from azure_openai import InteractWithOpenAI
+import os
+import re
 
 
 # Initialisierung der Funktion App
     
 # Konfiguration des Loggings
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-configure_azure_monitor()
+
+# Application Insights wird erst beim ersten Chat eingerichtet, nicht beim Laden der App:
+# Das Hochfahren von OpenTelemetry verlängert sonst jeden Kaltstart, auch für ping und status.
+_azure_monitor_configured = False
+
+def _configure_azure_monitor_once():
+    # Nur, wenn es konfiguriert ist; das OpenTelemetry-Paket wird sonst gar nicht erst geladen
+    global _azure_monitor_configured
+    if _azure_monitor_configured:
+        return
+    _azure_monitor_configured = True
+    if os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING"):
+        from azure.monitor.opentelemetry import configure_azure_monitor
+        configure_azure_monitor()
 
 # Erstellen der Funktion App
 
@@ -41,18 +52,38 @@ Andererseits hat für diese Anwendung die ASGI-Bridge keinen Mehrwert, im Gegent
 Deshalb behelfen wir uns mit einer kleinen Parameter-Klasse, um die Parameter zu isolieren.
 """
 
+class MissingParamsError(ValueError):
+    """
+    Wird geworfen, wenn Name, E-Mail oder Prompt in der Anfrage fehlen.
+    """
+
+# Grobe Plausibilitätsprüfung der E-Mail-Adresse und Obergrenze für die Länge des Prompts (Zeichen),
+# damit offensichtlich ungültige Anfragen gar nicht erst bei OpenAI landen. Die Adresse wird zum RowKey im Table Storage,
+# der keine Steuerzeichen erlaubt; fullmatch(), weil "$" auch vor einem abschließenden Zeilenumbruch passt.
+_EMAIL_RE = re.compile(r"[^@\s\x00-\x1f\x7f-\x9f]+@[^@\s\x00-\x1f\x7f-\x9f]+\.[^@\s\x00-\x1f\x7f-\x9f]+")
+_MAX_PROMPT_LENGTH = 8000
+
 # Hilfsklasse für Parameter für mock und chat Endpunkte / Routen / Operations
 class ChatRequestParams:
     """
     Hilfsklasse zur Extraktion und Speicherung von Anfrageparametern.
     """
+    __slots__ = ("user_name", "user_email", "user_prompt")
+
     def __init__(self, request: func.HttpRequest):
-        self.user_name = request.params.get("Name", "")
-        self.user_email = request.params.get("email", "")
-        self.user_prompt = request.params.get("prompt", "")
-        if not self.user_name or not self.user_email or not self.user_prompt:
-          logging.error("Fehlende Parameter: Name, E-Mail oder Prompt")
-          raise Exception("One or more parameters missing")
+        params = request.params
+        try:
+          self.user_name = params["Name"]
+          self.user_email = params["email"]
+          self.user_prompt = params["prompt"]
+        except KeyError as missing:
+          # Bricht beim ersten fehlenden Parameter ab
+          logging.error("Fehlender Parameter: %s", missing)
+          raise MissingParamsError(f"Parameter {missing} missing") from None
+        # Übergeben, aber leer, zählt ebenfalls als fehlend
+        if not (self.user_name and self.user_email and self.user_prompt):
+          logging.error("Leere Parameter: Name, E-Mail oder Prompt")
+          raise MissingParamsError("One or more parameters missing")
 
 @app.route(route="mock", methods=["GET", "POST"])
 def mock(req: func.HttpRequest) -> func.HttpResponse:
@@ -61,10 +92,9 @@ def mock(req: func.HttpRequest) -> func.HttpResponse:
     """
     try: 
       params = ChatRequestParams(req)
-    except Exception as e:
+    except MissingParamsError as e:
       return func.HttpResponse(f"An error has occured: {e}", status_code=400)
 
-    time_stamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")               
     return func.HttpResponse(f"Hello, {params.user_name}! So you like to talk about {params.user_prompt}", status_code=200)
 
 # Hauptendpunkt für den Chat
@@ -79,17 +109,31 @@ async def chat(req: func.HttpRequest) -> func.HttpResponse:
     # Parameter aus der Anfrage extrahieren.
     try:
       params = ChatRequestParams(req)
-    except Exception as e:
+    except MissingParamsError as e:
       return func.HttpResponse(f"An error has occured: {e}", status_code=400)
 
+    # Günstige Prüfungen zuerst: Ungültige Anfragen kosten so weder eine Table-Storage- noch eine OpenAI-Abfrage
+    if not _EMAIL_RE.fullmatch(params.user_email):
+      return func.HttpResponse("An error has occured: Invalid email address", status_code=400)
+    if len(params.user_prompt) > _MAX_PROMPT_LENGTH:
+      return func.HttpResponse(f"An error has occured: Prompt longer than {_MAX_PROMPT_LENGTH} characters", status_code=400)
+
     # async with InteractWithOpenAI() as interaction:
     #     logging.info(f"Chat-Endpoint: Calling... {params.user_email} mit Prompt: {prompt}")
     #     http_status, response = await interaction.chat(params.user_email, prompt)
     #     logging.info(f"Chat-Endpoint came back: Response: {http_status}: {response}")
 
+    # Läuft synchron auf der Event-Loop: Der erste Chat eines Workers trägt das Hochfahren von OpenTelemetry
+    # (und blockiert dabei parallele Anfragen), danach bleibt nur die Abfrage des Merkers
+    _configure_azure_monitor_once()
+
+    # Erst hier importiert, damit ping, status und mock beim Kaltstart nicht das OpenAI-, Tables- und Event-Grid-SDK laden
+    from azure_openai import InteractWithOpenAI
+
     interaction = InteractWithOpenAI()
     try:
-        logging.info(f"Chat-Endpoint: Calling... {params.user_email} mit Prompt: {params.user_prompt}")
+        # Only the prompt length at INFO: the prompt itself is personal data and would go to App Insights as well
+        logging.info("Chat-Endpoint: Calling... %s mit Prompt der Länge %d", params.user_email, len(params.user_prompt))
         http_status, response_body = await interaction.chat(params.user_name, params.user_email, params.user_prompt)
         # logging.info(f"Chat-Endpoint came back: Response: {http_status}: {response}")
     finally:
@@ -98,10 +142,14 @@ async def chat(req: func.HttpRequest) -> func.HttpResponse:
     try:
         return func.HttpResponse(response_body, status_code=http_status, headers={"Content-Type": "text/plain; charset=utf-8"})
     except Exception as e:
-        logging.error(f"Error returning the response: {e}")
+        logging.error("Error returning the response: %s", e)
         return func.HttpResponse("Internal server error", status_code=500)
 
 # Ping- und Status-Endpunkte, noch zu implementieren
+# Die Antworten sind konstant und liegen deshalb schon fertig kodiert vor
+_PONG = b"pong"
+_STATUS_BODY = b'{"chat_service": {"openai": "good", "database": "good"}}'
+
 # Ggf. separate Parameter-Klassen für Ping und Status implementieren
 @app.route(route="ping", methods=["GET"])
 def ping(req: func.HttpRequest) -> func.HttpResponse:
@@ -110,7 +158,7 @@ def ping(req: func.HttpRequest) -> func.HttpResponse:
     """
     #TODO: Implementierung der Ping-Logik
     logging.info('Ping function processed a request.')
-    return func.HttpResponse("pong", status_code=200)
+    return func.HttpResponse(_PONG, status_code=200)
 
 
 @app.route(route="status", methods=["GET"])
@@ -120,7 +168,7 @@ def alive(req: func.HttpRequest) -> func.HttpResponse:
     """
     logging.info('Alive function processed a request.')
     #TODO: Implementierung der Status-Logik
-    return func.HttpResponse('{"chat_service": {"openai": "good", "database": "good"}}', status_code=200, mimetype="application/json")
+    return func.HttpResponse(_STATUS_BODY, status_code=200, mimetype="application/json")
 
 
 
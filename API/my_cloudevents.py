@@ -1,87 +1,87 @@
 """
 Titel: my_cloudevents.py
-Beschreibung:   Implementiert eine Basisklasse für CloudEvents, die in Azure verwendet werden können.
+Beschreibung:   Erzeugt die CloudEvents, die diese Anwendung ans Azure Event Grid sendet.
 Autor: Tim Walter (TechPrototyper)
 Datum: 2024-04-11
-Version: 1.1.0
+Version: 1.3.0
 Quellen: [Azure Event Grid], [CloudEvents Spezifikation]
 Kontakt: projekte@tim-walter.net
 """
 
 """
 Version 1.1: Umstellung auf Factory Methoden
+Version 1.2: Die Factory Methoden unterschieden sich nur im Typ; sie sind durch eine Tabelle
+             und eine einzige Funktion create_event() ersetzt
+Version 1.3: Events sind einfache Dictionaries im JSON-Format der CloudEvents Spezifikation
 """
 
-from datetime import datetime, timezone
+import time
 import uuid
-from cloudevents.http import CloudEvent # cloudevents library contains Format and HTTP bindings for CloudEvents
 from os import getenv
 
 # Requires environment variables:
 # - EVENT_GRID_APPLICATION_ID
 # - APP_NAMESPACE
+# Both are constant for the lifetime of the worker process, so they are read once at import.
+_SOURCE = getenv("EVENT_GRID_APPLICATION_ID")
+_NAMESPACE = getenv("APP_NAMESPACE")
 
-class BaseCloudEvent:
-    def __init__(self, source: str, type: str, data: dict) -> None:
-        
-        if source:
-            self.source = source
-        else:
-            try:
-                self.source = getenv("EVENT_GRID_APPLICATION_ID")
-            except KeyError:
-                raise ValueError("Error: source must be provided or set as environment variable EVENT_GRID_APPLICATION_ID")
-        
-        try:
-            self.type = getenv("APP_NAMESPACE")+type # APP_NAMESPACE is the namespace of the application; has been moved here from the UserRegisteredEvent class
-        except KeyError:
-            raise ValueError("Error: App namespace  must be provided or set as environment variable APP_NAMESPACE")
-        
-        self.specversion = '1.0'
-        self.id = str(uuid.uuid4())
-        self.time = datetime.now(timezone.utc).isoformat()
-        self.data = data
+# Event type as used in the application -> type on the grid (without the APP_NAMESPACE prefix)
+EVENT_TYPES = {
+    "user.registered": "user.registered",
+    "user.login": "user.login",
+    "prompt.from.user": "user.prompt",
+    "prompt.to.user": "user.response",
+    "prompt.to.ai": "backend.prompt",
+    "prompt.from.ai": "backend.response",
+    "chat.ended": "user.chatended",
+    "error": "system.error",
+}
 
-    def to_cloudevent(self):
-        attributes = {
-            "specversion": self.specversion,
-            "id": self.id,
-            "source": self.source,
-            "type": self.type,
-            "time": self.time,
-            "data": self.data
-        }
-        return CloudEvent(attributes, self.data)
+# The attributes that are the same for every event of a type, built once at import
+_TEMPLATES = {
+    event_type: {"specversion": "1.0", "source": _SOURCE, "type": f"{_NAMESPACE}{grid_type}"}
+    for event_type, grid_type in EVENT_TYPES.items()
+}
 
-    @classmethod
-    def create_user_registered_event(cls, user_details: dict):
-        return cls("", "user.registered", user_details).to_cloudevent()
+# Last formatted second as (epoch seconds, "YYYY-MM-DDTHH:MM:SS"), see _iso_now()
+_formatted_second = (None, "")
 
-    @classmethod
-    def create_user_login_event(cls, user_details: dict):
-        return cls("", "user.login", user_details).to_cloudevent()
+def _iso_now() -> str:
+    # RFC 3339 timestamp in UTC, e.g. "2024-04-11T08:15:30.123456Z".
+    # Events of one chat turn are created within the same second, so the date/time part
+    # is formatted once per second and only the microseconds are added per event.
+    global _formatted_second
+    seconds, micros = divmod(time.time_ns() // 1000, 1000000)
+    cached_second, formatted = _formatted_second
+    if seconds != cached_second:
+        formatted = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds))
+        _formatted_second = (seconds, formatted)
+    return f"{formatted}.{micros:06d}Z"
 
-    @classmethod
-    def create_prompt_from_user_event(cls, prompt_details: dict):
-        return cls("", "user.prompt", prompt_details).to_cloudevent()
+def create_event(event_type: str, data: dict) -> dict:
+    """
+    Erzeugt ein CloudEvent des gegebenen Typs.
+    Das Event ist ein Dictionary im JSON-Format der CloudEvents Spezifikation, das der EventGridPublisherClient
+    unverändert übernimmt. Ein cloudevents.http.CloudEvent würde dort erst zu JSON kodiert und wieder
+    eingelesen, bevor der ganze Batch noch einmal kodiert wird.
 
-    @classmethod
-    def create_prompt_to_user_event(cls, prompt_details: dict):
-        return cls("", "user.response", prompt_details).to_cloudevent()
+    :param event_type: Der Event-Typ, ein Schlüssel aus EVENT_TYPES, z.B. "prompt.from.ai".
+    :param data: Die Nutzdaten des Events.
+    :return: Das CloudEvent als Dictionary.
+    :raises ValueError: Wenn der Event-Typ unbekannt ist oder die Umgebungsvariablen fehlen.
+    """
+    template = _TEMPLATES.get(event_type)
+    if template is None:
+        raise ValueError(f"Error: Unknown event type {event_type}")
 
-    @classmethod
-    def create_prompt_to_ai_event(cls, prompt_details: dict):
-        return cls("", "backend.prompt", prompt_details).to_cloudevent()
-
-    @classmethod
-    def create_prompt_from_ai_event(cls, prompt_details: dict):
-        return cls("", "backend.response", prompt_details).to_cloudevent()
-
-    @classmethod
-    def create_chat_ended_event(cls, chat_summary_details: dict):
-        return cls("", "user.chatended", chat_summary_details).to_cloudevent()
-
-    @classmethod
-    def create_error_event(cls, error_details: dict):
-        return cls("", "system.error", error_details).to_cloudevent()
+    if not _SOURCE:
+        raise ValueError("Error: source must be set as environment variable EVENT_GRID_APPLICATION_ID")
+    if not _NAMESPACE:
+        raise ValueError("Error: App namespace must be set as environment variable APP_NAMESPACE")
 
+    event = template.copy()
+    event["id"] = str(uuid.uuid4())
+    event["time"] = _iso_now()
+    event["data"] = data
+    return event
@@ -4,6 +4,7 @@ Titel: o_openai.py
 Beschreibung:   Stellt die Kommunikation zwischen der Funktion App und der OpenAI API her.
                 OpenAI Backend.
                 "Schwesterdatei" ist azure_openai.py, die auf OpenAI-Endpunkte in Azure zugreift.
+                Umstellung auf async analog zu azure_openai.py.
                 Anmerkung, 4.4.2024: Die Datei ist nicht mehr auf Stand und muss gelegentlich
                 nachgezogen werden.
                 
@@ -14,16 +15,49 @@ Quellen: [OpenAI API Dokumentation], [Azure Functions Dokumentation], [Azure Tab
 Kontakt: projekte@tim-walter.net
 """
 
-from openai import OpenAI
-from user_threads import UserThreads
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+import httpx
+from user_threads import get_users
 from typing import Tuple
-import time
+import functools
 import os
 import logging
 
 # Konfiguration des Loggings
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Run-Zustände, in denen der Run noch auf dem Thread aktiv ist
+_OPEN_RUN_STATUSES = ("queued", "in_progress", "requires_action")
+
+
+@functools.lru_cache(maxsize=1)
+def _get_client() -> AsyncOpenAI:
+    """
+    Liefert den prozessweit geteilten OpenAI Client. Er wird beim ersten Aufruf angelegt und
+    bleibt für die Lebensdauer des Workers offen, damit TLS-Verbindungen über Anfragen hinweg wiederverwendet werden.
+
+    :raises EnvironmentError: Wenn OPENAI_API_KEY nicht gesetzt ist.
+    :raises Exception: Wenn keine Verbindung zur OpenAI API hergestellt werden kann.
+    """
+    api_key = os.getenv("OPENAI_API_KEY")
+
+    if not api_key:
+        logging.error("OPENAI_API_KEY ist nicht gesetzt.")
+        raise EnvironmentError("OPENAI_API_KEY Umgebungsvariable ist nicht gesetzt.")
+
+    try:
+        # Keep-alive pool with HTTP/2, same settings as in azure_openai.py (SDK defaults, 600s read timeout for streams)
+        http_client = DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            timeout=httpx.Timeout(600.0, connect=5.0)
+        )
+        return AsyncOpenAI(api_key=api_key, http_client=http_client)
+    except Exception as e:
+        logging.error(f"Konnte keine Verbindung zur OpenAI API herstellen: {e}")
+        raise
+
+
 class InteractWithOpenAI:
     """
     Diese Klasse handhabt die Kommunikation mit der OpenAI API.
@@ -31,67 +65,50 @@ class InteractWithOpenAI:
 
     def __init__(self):
         """
-        Initialisiert die Verbindung zur OpenAI API und liest Konfigurationsparameter.
+        Übernimmt den geteilten OpenAI Client und liest Konfigurationsparameter.
         """
-        api_key = os.getenv("OPENAI_API_KEY")
         self.main_assistant_id = os.getenv("OPENAI_MAIN_ASSISTANT_ID")
-        
-        if not api_key:
-            logging.error("OPENAI_API_KEY ist nicht gesetzt.")
-            raise EnvironmentError("OPENAI_API_KEY Umgebungsvariable ist nicht gesetzt.")
-        
-        try:
-            self.client = OpenAI(api_key=api_key)
-        except Exception as e:
-            logging.error(f"Konnte keine Verbindung zur OpenAI API herstellen: {e}")
-            raise
+        self.client = _get_client()
+        # Die prozessweit geteilte UserThreads-Instanz; erst in get_or_create_thread() geholt, innerhalb von chat()s try
+        self.threads = None
 
-    def close(self):
+    async def close(self):
         """
-        Schließt die Verbindung zur OpenAI API und zu Azure Table Storage.
+        Gibt die Ressourcen des Dialogschrittes frei. Der OpenAI Client und die UserThreads-Instanz
+        werden prozessweit geteilt und bleiben deshalb offen; derzeit gibt es hier nichts zu tun.
         """
-        if hasattr(self, 'client') and hasattr(self.client, 'close'):
-            self.client.close()
-            logging.info("OpenAI API Verbindung geschlossen.")
-        if hasattr(self, 'threads') and hasattr(self.threads, 'close'):
-            self.threads.close()
-            logging.info("Azure Table Storage Verbindung geschlossen.")
-
-    def __enter__(self):
+
+    async def __aenter__(self):
         # Beim Betreten des Kontexts, bleibt unverändert
         return self
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
         # Beim Verlassen des Kontexts, Ressourcenfreigabe
-        self.close()
+        await self.close()
 
         return False
 
-    def get_or_create_thread(self, user_email: str) -> str:
+    async def get_or_create_thread(self, user_email: str) -> str:
         """
         Ermittelt oder erstellt einen Thread für den gegebenen Benutzer.
         
         :param user_email: E-Mail-Adresse des Benutzers.
         :return: Thread-ID
         """
+        async def create_thread() -> str:
+            thread = await self.client.beta.threads.create()
+            return thread.id
+
         try:
-            self.threads = UserThreads()
-            thread_id = self.threads.get_id(user_email)
-        except LookupError:
-            try:
-                thread = self.client.beta.threads.create()
-                thread_id = thread.id
-                self.threads.set_id(user_email, thread_id)
-            except Exception as e:
-                logging.error(f"Fehler bei der Thread-Erstellung oder -Speicherung: {e}")
-                raise
+            self.threads = get_users()
+            thread_id, _ = await self.threads.get_or_set_id(user_email, create_thread)
         except Exception as e:
-            logging.error(f"Fehler beim Zugriff auf die Thread-Historie: {e}")
+            logging.error(f"Fehler bei der Thread-Ermittlung, -Erstellung oder -Speicherung: {e}")
             raise
         
         return thread_id
 
-    def chat(self, user_email: str, prompt: str) -> Tuple[int, str]:
+    async def chat(self, user_email: str, prompt: str) -> Tuple[int, str]:
         """
         Sendet den Prompt des Benutzers an den Assistant und verarbeitet die Antwort.
 
@@ -100,34 +117,46 @@ class InteractWithOpenAI:
         :return: Antwort des Assistants.
         """
         try:                
-            thread_id = self.get_or_create_thread(user_email)
+            thread_id = await self.get_or_create_thread(user_email)
             logging.info(f"Thread ID: {thread_id}")
 
-            self.client.beta.threads.messages.create(
+            await self.client.beta.threads.messages.create(
                 thread_id=thread_id,
                 role="user",
                 content=prompt
             )
 
-            run = self.client.beta.threads.runs.create(
+            # Der Run wird gestreamt statt im Sekundentakt abgefragt; der Stream endet mit dem Run
+            # und liefert die Antwort gleich mit, ein separates messages.list entfällt.
+            message = None
+            async with self.client.beta.threads.runs.stream(
                 thread_id=thread_id,
                 assistant_id=self.main_assistant_id
-            )
+            ) as stream:
+                async for event in stream:
+                    if event.event == "thread.message.completed":
+                        message = event.data
+                updated_run = stream.current_run
 
-            while True:
-                updated_run = self.client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-                if updated_run.status in ["completed", "failed", "cancelled", "expired"]:
-                    break
-                time.sleep(1)
+            if updated_run is None:
+                logging.error("Problem beim Durchführen des Runs: kein Run-Status erhalten")
+                return 500, "*ISSUE* **Run Status: unknown**"
 
             if updated_run.status == "completed":
-                messages = self.client.beta.threads.messages.list(thread_id=thread_id)
-                if messages.data and messages.data[0].content and len(messages.data[0].content) > 0:
-                    return 200, messages.data[0].content[0].text.value
+                if message and message.content and len(message.content) > 0:
+                    return 200, message.content[0].text.value
                 else:
                     return 200, "No response message found."
             else:
                 logging.error(f"Problem beim Durchführen des Runs: {updated_run.status}")
+                if updated_run.status in _OPEN_RUN_STATUSES:
+                    # Dieses Backend führt keine Tool Calls aus; ein offener Run würde den Thread bis zu seinem
+                    # Ablauf blockieren, und jeder weitere Prompt des Benutzers schlüge fehl
+                    try:
+                        await self.client.beta.threads.runs.cancel(run_id=updated_run.id, thread_id=thread_id)
+                        logging.info(f"Run {updated_run.id} abgebrochen.")
+                    except Exception as e:
+                        logging.error(f"Run {updated_run.id} konnte nicht abgebrochen werden: {e}")
                 return 500, f"*ISSUE* **Run Status: {updated_run.status}**"
         
         except Exception as e:
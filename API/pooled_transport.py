@@ -0,0 +1,32 @@
+"""
+Titel:          pooled_transport.py
+Beschreibung:   Baut den aiohttp-Transport für die prozessweit geteilten Azure SDK Clients
+                (Table Storage in user_threads.py, Event Grid in event_grid_publisher.py).
+Autor:          Tim Walter (TechPrototyper)
+Version:        1.0.0
+Quellen:        [Azure SDK for Python, azure-core]
+Kontakt:        projekte@tim-walter.net
+"""
+
+import aiohttp
+from azure.core.pipeline.transport import AioHttpTransport
+
+def create_transport(**connector_options) -> AioHttpTransport:
+    """
+    Erzeugt einen AioHttpTransport auf einer eigenen aiohttp-Session mit abgestimmtem Verbindungspool.
+    Die Session lebt so lange wie der Client, dem der Transport übergeben wird; bei den prozessweit geteilten
+    Clients also über alle Anfragen des Workers hinweg. Sie ist an die laufende Event-Loop gebunden und muss
+    deshalb darin angelegt werden.
+
+    :param connector_options: Einstellungen für den aiohttp.TCPConnector, z.B. keepalive_timeout.
+    :return: Der Transport; schließt der Client ihn, wird auch die Session geschlossen.
+    """
+    # Bis auf den Connector dieselben Einstellungen, mit denen azure-core seine Session selbst anlegt:
+    # Proxy aus HTTP(S)_PROXY, keine Cookies über Anfragen hinweg, Dekomprimierung durch azure-core.
+    session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(**connector_options),
+        trust_env=True,
+        cookie_jar=aiohttp.DummyCookieJar(),
+        auto_decompress=False
+    )
+    return AioHttpTransport(session=session)
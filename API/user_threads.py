@@ -16,11 +16,70 @@ Todo: Umbenennung der Klasse in Users, da jetzt neben der User-Thread-Zuordnung
 """
 
 import os
+import time
+import asyncio
+import contextlib
 import logging
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.data.tables import UpdateMode
 from azure.data.tables.aio import TableServiceClient
+from pooled_transport import create_transport
 
-# Konfiguration des Loggings
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Eigener Logger; Format und Level legt der Einstiegspunkt (function_app.py) fest
+logger = logging.getLogger(__name__)
+
+# Prozessweiter Zwischenspeicher für Thread-IDs: RowKey -> (gültig bis, Thread-ID).
+# Die Thread-ID ändert sich praktisch nie. Die Mitleseerlaubnis (ExtendedEvents) wird bewusst nicht
+# zwischengespeichert: Ein Widerruf muss sofort auf allen Instanzen gelten, siehe get_extended_events().
+_THREAD_ID_CACHE_TTL = 60.0 # Sekunden
+_THREAD_ID_CACHE_MAX = 10000 # Einträge
+_thread_id_cache = {}
+
+# Laufende Abfragen je Benutzer: Gleichzeitige Anfragen für denselben Benutzer warten bei einem Cache-Miss
+# auf dieselbe Abfrage, statt jede für sich den Table Storage zu fragen. Der Eintrag verschwindet mit ihrem Ende.
+_pending_reads = {}
+
+# Sperren je Benutzer für Lesen-dann-Schreiben: RowKey -> [Lock, Anzahl Nutzer]. Parallele Anfragen desselben
+# Benutzers in diesem Worker schreiben nacheinander statt gegeneinander. Der Eintrag verschwindet mit dem letzten Nutzer.
+_user_locks = {}
+
+# Prozessweite Instanz, siehe get_users()
+_instance = None
+
+# Verbindungspool zum Table Storage: Leerlaufende Verbindungen bleiben länger als die 15s von aiohttp offen,
+# damit die Pause zwischen zwei Dialogschritten keinen neuen TLS-Handshake kostet; DNS wird 5 Minuten gecacht.
+_POOL_LIMIT = 100
+_KEEPALIVE_TIMEOUT = 120
+_DNS_CACHE_TTL = 300
+
+# Höchstzahl an Operationen je Entity Group Transaction (Vorgabe von Azure Table Storage)
+_TRANSACTION_LIMIT = 100
+# Höchstzahl gleichzeitiger Einzelabfragen bei Massenabfragen
+_MAX_CONCURRENT_READS = 32
+
+def _cache_thread_id(user_id: str, thread_id: str):
+    # Bei vollem Speicher fliegt der älteste Eintrag raus (dict behält die Einfügereihenfolge)
+    _thread_id_cache.pop(user_id, None)
+    if len(_thread_id_cache) >= _THREAD_ID_CACHE_MAX:
+        _thread_id_cache.pop(next(iter(_thread_id_cache)))
+    _thread_id_cache[user_id] = (time.monotonic() + _THREAD_ID_CACHE_TTL, thread_id)
+
+@contextlib.asynccontextmanager
+async def _user_lock(user_id: str):
+    # Liefert True, wenn zuvor schon jemand die Sperre hielt, das Gelesene also veraltet sein kann
+    entry = _user_locks.get(user_id)
+    if entry is None:
+        entry = _user_locks[user_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        contended = entry[0].locked()
+        async with entry[0]:
+            yield contended
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _user_locks[user_id]
 
 class UserThreads:
     """
@@ -33,16 +92,25 @@ class UserThreads:
         """
         self.connection_string = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
         if not self.connection_string:
-            logging.error("AZURE_STORAGE_CONNECTION_STRING Umgebungsvariable ist nicht gesetzt.")
+            logger.error("AZURE_STORAGE_CONNECTION_STRING Umgebungsvariable ist nicht gesetzt.")
             raise EnvironmentError("AZURE_STORAGE_CONNECTION_STRING Umgebungsvariable ist nicht gesetzt. Function App muss konfiguriert werden.")
         
         self.table_name = "UserThreads"
-        logging.info(f"UserThreads-Objekt erstellt.")
 
-        # In der async-Variante haben wir keine dauerhaften Verbindungs-Objekte, sondern müssen die Connection per Request händeln:
-        # self.table_service = TableServiceClient.from_connection_string(conn_str=self.connection_string)
-        # self.table_client = self.table_service.get_table_client(table_name=self.table_name)
-        # logging.info("Verbindung zu Azure Table Service hergestellt.")
+        # Ein Client für die Lebensdauer des Objekts; er teilt seinen aiohttp-Verbindungspool über alle Methoden,
+        # statt pro Aufruf eine neue Session samt TLS-Handshake aufzubauen.
+        # Die Session ist an die laufende Event-Loop gebunden, das Objekt muss also darin angelegt werden.
+        transport = create_transport(
+            limit=_POOL_LIMIT,
+            keepalive_timeout=_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=_DNS_CACHE_TTL
+        )
+        self.table_service = TableServiceClient.from_connection_string(
+            conn_str=self.connection_string,
+            transport=transport
+        )
+        self.table_client = self.table_service.get_table_client(table_name=self.table_name)
+        logger.info("UserThreads-Objekt erstellt.")
 
     async def get_id(self, user_id: str) -> str:
         """
@@ -51,15 +119,19 @@ class UserThreads:
         :param user_id: Die ID des Benutzers.
         :return: Die ID des Threads.
         """
+        cached = _thread_id_cache.get(user_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
         try:
-            async with TableServiceClient.from_connection_string(self.connection_string) as table_service:
-                table_client = table_service.get_table_client(table_name=self.table_name)
-                user = await table_client.get_entity(partition_key="Chat", row_key=user_id)
-            logging.info(f"Thread für Benutzer gefunden, ID: {user['ThreadId']}")
-            return user["ThreadId"]
-        except Exception as e:
-            logging.info(f"Thread für Benutzer {user_id} nicht gefunden.")
-            raise LookupError("ThreadNotFound") from e
+            user = await self.get_user_data(user_id)
+            thread_id = user["ThreadId"]
+            logger.debug("Thread für Benutzer gefunden, ID: %s", thread_id)
+            _cache_thread_id(user_id, thread_id)
+            return thread_id
+        except LookupError: # Unbekannter Benutzer oder Zeile ohne ThreadId (KeyError)
+            logger.info("Thread für Benutzer %s nicht gefunden.", user_id)
+            raise LookupError("ThreadNotFound") from None
 
     async def set_id(self, user_id: str, thread_id: str) -> int:
         """
@@ -69,24 +141,94 @@ class UserThreads:
         :param thread_id: Die zu speichernde Thread-ID.
         :return: True, wenn die Operation erfolgreich war, sonst False.
         """
-        try:
-            async with TableServiceClient.from_connection_string(self.connection_string) as table_service:
-                table_client = table_service.get_table_client(table_name=self.table_name)
+        async with _user_lock(user_id):
+            try:
                 user = {
                     "PartitionKey": "Chat",
                     "RowKey": user_id,
                     "ThreadId": thread_id,
-                    "ExtendedEvents": "0"
+                    "ExtendedEvents": False
                 }
-                await table_client.upsert_entity(entity=user)
+                try:
+                    # Der übliche Fall ist ein neuer Benutzer: ein einziger Roundtrip
+                    await self.table_client.create_entity(entity=user)
+                    _cache_thread_id(user_id, thread_id)
+
+                except ResourceExistsError:
+                    # Den Benutzer gibt es schon: Nur die Thread-ID wird per MERGE geändert, damit die Mitleseerlaubnis
+                    # erhalten bleibt, und nur, wenn sie sich tatsächlich ändert. Das ETag stellt sicher,
+                    # dass zwischen Lesen und Schreiben niemand sonst die Zeile geändert hat.
+                    current = await self.table_client.get_entity(partition_key="Chat", row_key=user_id, select=["ThreadId"])
+                    if current.get("ThreadId") == thread_id:
+                        logger.info("Thread-ID %s für Benutzer %s war bereits gesetzt.", thread_id, user_id)
+                        return 1
+                    await self.table_client.update_entity(
+                        entity={"PartitionKey": "Chat", "RowKey": user_id, "ThreadId": thread_id},
+                        mode=UpdateMode.MERGE,
+                        etag=current.metadata["etag"],
+                        match_condition=MatchConditions.IfNotModified
+                    )
+                    _cache_thread_id(user_id, thread_id)
             
-            logging.info(f"Thread-ID {thread_id} für Benutzer {user_id} gesetzt.")
-            return 1
+                logger.info("Thread-ID %s für Benutzer %s gesetzt.", thread_id, user_id)
+                return 1
         
-        except Exception as e:
-            logging.error(f"Fehler beim Speichern der Thread-ID für Benutzer {user_id}.")
-            raise IOError("ThreadPersistenceFailed") from e
+            except Exception as e:
+                logger.error("Fehler beim Speichern der Thread-ID für Benutzer %s.", user_id)
+                raise IOError("ThreadPersistenceFailed") from e
         
+    async def get_or_set_id(self, user_id: str, thread_factory) -> tuple:
+        """
+        Ruft die Thread-ID für einen Benutzer ab oder legt, wenn er noch keine hat, einen Thread an und speichert ihn.
+        Laufen zwei Anfragen eines neuen Benutzers gleichzeitig hier hinein, gewinnt die zuerst gespeicherte Thread-ID;
+        beide Aufrufer bekommen dieselbe zurück.
+
+        :param user_id: Die ID des Benutzers.
+        :param thread_factory: Coroutine-Funktion ohne Parameter, die einen neuen Thread anlegt und seine ID liefert.
+        :return: Tupel aus Thread-ID und True, wenn sie neu angelegt wurde, sonst False.
+        """
+        try:
+            return await self.get_id(user_id), False
+        except LookupError:
+            pass
+
+        async with _user_lock(user_id) as contended:
+            if contended:
+                # Eine parallele Anfrage dieses Workers hat den Benutzer vermutlich gerade angelegt
+                try:
+                    return await self.get_id(user_id), False
+                except LookupError:
+                    pass
+
+            thread_id = await thread_factory()
+            user = {
+                "PartitionKey": "Chat",
+                "RowKey": user_id,
+                "ThreadId": thread_id,
+                "ExtendedEvents": False
+            }
+            try:
+                # Anlegen statt Upsert: schlägt fehl, falls der Benutzer inzwischen auf einer anderen Instanz angelegt wurde
+                await self.table_client.create_entity(entity=user)
+                _cache_thread_id(user_id, thread_id)
+                logger.info("Thread-ID %s für Benutzer %s gesetzt.", thread_id, user_id)
+                return thread_id, True
+            except ResourceExistsError:
+                _thread_id_cache.pop(user_id, None)
+                try:
+                    existing_thread_id = await self.get_id(user_id)
+                    logger.info("Benutzer %s wurde parallel angelegt, verwende Thread-ID %s.", user_id, existing_thread_id)
+                    return existing_thread_id, False
+                except LookupError:
+                    pass # Die Zeile gibt es, aber ohne Thread-ID
+            except Exception as e:
+                logger.error("Fehler beim Speichern der Thread-ID für Benutzer %s.", user_id)
+                raise IOError("ThreadPersistenceFailed") from e
+
+        # Außerhalb der Sperre, set_id() nimmt sie selbst
+        await self.set_id(user_id, thread_id)
+        return thread_id, True
+
     async def get_extended_events(self, user_id: str) -> int:
         """
         Ruft die Schalterstellung für erweiterte Events für einen gegebenen Benutzer ab.
@@ -95,13 +237,17 @@ class UserThreads:
         :return: Schalterstellung; 0 für ausgeschaltet, 1 für eingeschaltet.
         """
         try:
-            async with TableServiceClient.from_connection_string(self.connection_string) as table_service:
-                table_client = table_service.get_table_client(table_name=self.table_name)
-                user = await table_client.get_entity(partition_key="Chat", row_key=user_id)
-            return int(user["ExtendedEvents"]) # Schalter ist 0 oder 1
-        except Exception as e:
-            logging.info(f"Erweiterte Events für Benutzer {user_id} nicht gefunden.")
-            raise LookupError("ExtendedEventsNotFound") from e
+            # Immer frisch aus dem Table Storage: Die Erlaubnis kann auf einer anderen Instanz widerrufen worden sein,
+            # und danach darf kein Prompt des Benutzers mehr ans Event Grid gehen.
+            user = await self.table_client.get_entity(partition_key="Chat", row_key=user_id, select=["ExtendedEvents"])
+            extended_events = user["ExtendedEvents"]
+            # Neu geschrieben als Edm.Boolean; ältere Zeilen enthalten noch "0"/"1" (String) oder 0/1 (Int32)
+            if not isinstance(extended_events, bool):
+                extended_events = bool(int(extended_events))
+            return int(extended_events) # Schalter ist 0 oder 1
+        except (ResourceNotFoundError, LookupError, ValueError): # Unbekannter Benutzer, fehlender oder unlesbarer Schalter
+            logger.info("Erweiterte Events für Benutzer %s nicht gefunden.", user_id)
+            raise LookupError("ExtendedEventsNotFound") from None
         
     async def set_extended_events(self, user_id: str, extended_events: int) -> int:
         """
@@ -112,15 +258,18 @@ class UserThreads:
         :return: 1, wenn die Operation erfolgreich war, sonst 0.
         """
         try:
-            async with TableServiceClient.from_connection_string(self.connection_string) as table_service:
-                table_client = table_service.get_table_client(table_name=self.table_name)            
-                user = await table_client.get_entity(partition_key="Chat", row_key=user_id)
-                user["ExtendedEvents"] = int(extended_events)
-                await table_client.upsert_entity(entity=user)
-            logging.info(f"Erweiterte Events für Benutzer {user_id} auf {int(extended_events)} gesetzt.")
+            # Nur der Schalter wird per MERGE geschrieben, die übrigen Eigenschaften bleiben unberührt;
+            # so entfällt das vorherige Lesen der Entität. Gibt es den Benutzer nicht, schlägt das Update fehl.
+            user = {
+                "PartitionKey": "Chat",
+                "RowKey": user_id,
+                "ExtendedEvents": bool(int(extended_events)) # int() zuerst, der Wert kann auch "0" sein
+            }
+            await self.table_client.update_entity(entity=user, mode=UpdateMode.MERGE)
+            logger.info("Erweiterte Events für Benutzer %s auf %d gesetzt.", user_id, int(extended_events))
             return 1
         except Exception as e:
-            logging.error(f"Fehler beim Speichern der erweiterten Events für Benutzer {user_id}.")
+            logger.error("Fehler beim Speichern der erweiterten Events für Benutzer %s.", user_id)
             raise IOError("ExtendedEventsPersistenceFailed") from e
     
     async def get_user_data(self, user_id: str) -> dict:
@@ -130,14 +279,24 @@ class UserThreads:
         :param user_id: Die ID des Benutzers.
         :return: Die Benutzerdaten als Dictionary.
         """
+        pending = _pending_reads.get(user_id)
+        if pending is None:
+            pending = asyncio.ensure_future(self._read_user_data(user_id))
+            _pending_reads[user_id] = pending
+            pending.add_done_callback(lambda _: _pending_reads.pop(user_id, None))
+        # shield: Bricht ein Wartender ab, läuft die Abfrage für die anderen weiter
+        return await asyncio.shield(pending)
+
+    async def _read_user_data(self, user_id: str) -> dict:
+        # Die eigentliche Abfrage zu get_user_data().
+        # Nur "nicht gefunden" wird zum LookupError; andere Fehler (z.B. Drosselung, Netzwerk) gehen unverändert
+        # an den Aufrufer, sonst bekäme ein bekannter Benutzer bei einer Störung einen neuen Thread.
         try:
-            async with TableServiceClient.from_connection_string(self.connection_string) as table_service:
-                table_client = table_service.get_table_client(table_name=self.table_name)
-                user = await table_client.get_entity(partition_key="Chat", row_key=user_id)
-            return user
-        except Exception as e:
-            logging.info(f"Benutzerdaten für Benutzer {user_id} nicht gefunden.")
-            raise LookupError("UserDataNotFound") from e
+            user = await self.table_client.get_entity(partition_key="Chat", row_key=user_id)
+        except ResourceNotFoundError:
+            logger.debug("Benutzerdaten für Benutzer %s nicht gefunden.", user_id)
+            raise LookupError("UserDataNotFound") from None
+        return user
         
     async def set_user_data(self, user_id: str, user_data: dict) -> int:
         """
@@ -148,25 +307,91 @@ class UserThreads:
         :return: 1, wenn die Operation erfolgreich war, sonst 0.
         """
         try:
-            async with TableServiceClient.from_connection_string(self.connection_string) as table_service:
-                table_client = table_service.get_table_client(table_name=self.table_name)
-                user_data["PartitionKey"] = "Chat"
-                user_data["RowKey"] = user_id
-                await table_client.upsert_entity(entity=user_data)
-            logging.info(f"Benutzerdaten für Benutzer {user_id} gesetzt.")
+            user_data["PartitionKey"] = "Chat"
+            user_data["RowKey"] = user_id
+            await self.table_client.upsert_entity(entity=user_data)
+            _thread_id_cache.pop(user_id, None)
+            logger.info("Benutzerdaten für Benutzer %s gesetzt.", user_id)
             return True
         except Exception as e:
-            logging.error(f"Fehler beim Speichern der Benutzerdaten für Benutzer {user_id}.")
+            logger.error("Fehler beim Speichern der Benutzerdaten für Benutzer %s.", user_id)
             raise IOError("UserDataPersistenceFailed") from e
 
+    async def set_user_data_many(self, items: list) -> int:
+        """
+        Speichert oder aktualisiert die Benutzerdaten für viele Benutzer.
+        Alle Benutzer liegen in der Partition "Chat", deshalb gehen je bis zu 100 Upserts
+        als eine Entity Group Transaction in einem einzigen Roundtrip raus.
+
+        :param items: Liste von Tupeln aus Benutzer-ID und zu speichernden Benutzerdaten; jede Benutzer-ID nur einmal.
+        :return: 1, wenn alle Operationen erfolgreich waren.
+        """
+        operations = []
+        for user_id, user_data in items:
+            user_data["PartitionKey"] = "Chat"
+            user_data["RowKey"] = user_id
+            operations.append(("upsert", user_data))
+
+        for start in range(0, len(operations), _TRANSACTION_LIMIT):
+            chunk = operations[start:start + _TRANSACTION_LIMIT]
+            try:
+                await self.table_client.submit_transaction(chunk)
+            except Exception as e:
+                # Eine Transaktion gilt ganz oder gar nicht; frühere Transaktionen bleiben bestehen
+                logger.error("Fehler beim Speichern der Benutzerdaten für %d Benutzer.", len(chunk))
+                raise IOError("UserDataPersistenceFailed") from e
+            finally:
+                for _, user_data in chunk:
+                    _thread_id_cache.pop(user_data["RowKey"], None)
+
+        logger.info("Benutzerdaten für %d Benutzer gesetzt.", len(operations))
+        return 1
+
+    async def get_ids_many(self, user_ids: list) -> dict:
+        """
+        Ruft die Thread-IDs für viele Benutzer ab. Die Abfragen laufen parallel,
+        aber höchstens 32 gleichzeitig, um den Table Storage nicht zu überlasten.
+
+        :param user_ids: Die IDs der Benutzer.
+        :return: Dictionary Benutzer-ID -> Thread-ID; Benutzer ohne Thread fehlen darin.
+        """
+        semaphore = asyncio.Semaphore(_MAX_CONCURRENT_READS)
+
+        async def get_id_limited(user_id):
+            async with semaphore:
+                return await self.get_id(user_id)
+
+        results = await asyncio.gather(*(get_id_limited(user_id) for user_id in user_ids), return_exceptions=True)
+        thread_ids = {}
+        for user_id, result in zip(user_ids, results):
+            if isinstance(result, LookupError):
+                continue
+            if isinstance(result, BaseException):
+                raise result
+            thread_ids[user_id] = result
+        return thread_ids
+
     async def close(self):
         """
-        Schließt die Verbindung zum Azure Table Service.
+        Schließt die Verbindung zum Azure Table Service samt der aiohttp-Session.
         """
-        # await self.table_service.close()
-        # logging.info("Verbindung zu Azure Table Service geschlossen.")
+        await self.table_service.close()
+        logger.info("Verbindung zu Azure Table Service geschlossen.")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
 
-        # Hier gibt es wegen der Umstellung auf async nichts mehr zu tun,
-        # da die Verbindung immer mit einem Kontext an Ort und Stelle in jeder Methode auf- und abgebaut wird.
 
-        pass
+def get_users() -> UserThreads:
+    """
+    Liefert die UserThreads-Instanz, die sich alle Anfragen dieses Worker-Prozesses teilen.
+    Sie wird beim ersten Aufruf angelegt; ihr Table-Client und dessen Verbindungen bleiben damit
+    über Anfragen hinweg offen und werden von den Aufrufern nicht geschlossen.
+    """
+    global _instance
+    if _instance is None:
+        _instance = UserThreads()
+    return _instance